@@ -13,17 +13,23 @@ import re
 import hashlib
 import shlex
 import tempfile
-from collections import defaultdict
-from typing import List
+import functools
+import multiprocessing
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import List, Tuple
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = logging.getLogger('do_build')
 # Use this command to compare resulting directories
 # git diff -W --word-diff /tmp/compare/4b5b263 /tmp/compare/d1bc5bf
 
-# WARNING WARNING WARNING
-#   DO NOT RUN this with --nocopy=1 on working tree if you have any local additions.
-#   It will nuke all non-repository files, multiple times over.
-# WARNING WARNING WARNING
+# Every commit is built in its own git worktree under TMPDIR, which is removed afterwards, so the working
+# tree in CWD is never touched.
+# With --nocopy=1 these worktrees are registered in the repository in CWD instead of in a temporary copy.
 
 CONFIGURE_EXTRA = [
     'EVENT_CFLAGS=-I/opt/libevent/include',
@@ -34,10 +40,18 @@ CONFIGURE_EXTRA = [
 DEFAULT_PARALLELISM = 4
 DEFAULT_ASSERTIONS = 0
 DEFAULT_NOCOPY = 0
+DEFAULT_CCACHE = 1
+DEFAULT_ZSTD = 0
 DEFAULT_PATCH = 'stripbuildinfo.patch'
 TMPDIR = tempfile.gettempdir()
 DEFAULT_TGTDIR = os.path.join(TMPDIR, 'compare')
 DEFAULT_REPODIR = os.path.join(TMPDIR, 'repo')
+# Analysis results per commit, keyed by hash of the built executables
+COMPARE_CACHE_DIR = os.path.join(TMPDIR, 'compare-cache')
+# Worktree per commit, suffixed with the commit id
+WORKTREE_PREFIX = os.path.join(TMPDIR, 'wt-')
+# Disassembled sections per object file, keyed by hash of the object file
+OBJDUMP_CACHE_DIR = os.path.join(TMPDIR, 'objdump-cache')
 
 # No debugging information (not used by analysis at the moment, saves on I/O)
 OPTFLAGS = ["-O0", "-g0"]
@@ -72,6 +86,21 @@ CPPFLAGS = []
 # objcopy: strip all symbols, debug info, and the hash header section
 OBJCOPY_ARGS = ['-R.note.gnu.build-id', '-g', '-S']
 OBJDUMP_ARGS = ['-C', '--no-show-raw-insn', '-d', '-r']
+# Section header in objdump output, followed by the section name and ':'
+_SECTION_PREFIX = b'Disassembly of section '
+_RODATA = b'.rodata'
+# Version of the post-processing of objdump output. Increase this when changing how
+# sections are split, filtered or written, so that cached results are not reused.
+ANALYSIS_VERSION = 1
+# Extension of section files, plain or zstd-compressed
+DIS_EXT = '.dis'
+DIS_ZST_EXT = '.dis.zst'
+# Commit ids are (possibly abbreviated) hexadecimal hashes
+_HEX_RE = re.compile('[0-9a-fA-F]+')
+# Number of threads per analysis process that hash and write sections
+WRITE_THREADS = 4
+_write_pool = None
+_write_pool_pid = None
 
 # Set QT_RCC_SOURCE_DATE_OVERRIDE so that koyotecoin-qt is deterministic
 os.environ['QT_RCC_SOURCE_DATE_OVERRIDE'] = '1'
@@ -83,6 +112,7 @@ RSYNC = os.getenv('RSYNC', 'rsync')
 OBJCOPY = os.getenv('OBJCOPY', 'objcopy')
 OBJDUMP = os.getenv('OBJDUMP', 'objdump')
 OBJEXT = os.getenv('OBJEXT', '.o')  # object file extension
+CCACHE = os.getenv('CCACHE', 'ccache')
 
 PYDIR = os.path.dirname(os.path.abspath(__file__))
 PATCHDIR = os.path.join(PYDIR, 'patches')
@@ -138,10 +168,10 @@ def shell_join(s) -> str:
     return ' '.join(shlex.quote(x) for x in s)
 
 
-def check_call(args) -> int:
+def check_call(args, cwd=None, env=None) -> int:
     '''Wrapper for subprocess.check_call that logs what command failed'''
     try:
-        subprocess.check_call(args)
+        subprocess.check_call(args, cwd=cwd, env=env)
     except Exception:
         logger.error('Command failed: {}'.format(shell_join(args)))
         raise
@@ -159,66 +189,239 @@ def cmd_exists(cmd) -> bool:
 
 def iterate_objs(srcdir) -> str:
     '''Iterate over all object files in srcdir'''
-    for (root, dirs, files) in os.walk(srcdir):
-        if not root.startswith(srcdir):
-            raise ValueError
-        root = root[len(srcdir)+1:]
-        for filename in files:
-            if filename.endswith(OBJEXT):
-                yield os.path.join(root, filename)
+    # os.scandir provides the file type without an extra stat() per entry
+    stack = [srcdir]
+    prefix = len(os.path.join(srcdir, ''))
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(OBJEXT):
+                    yield entry.path[prefix:]
+
+
+def link_git_file(src: str, dst: str) -> str:
+    '''
+    copy_function for shutil.copytree that hard links git objects, and copies all other files.
+    Objects are immutable, but other files such as reflogs are modified in place and must not be shared.
+    '''
+    if os.sep + 'objects' + os.sep in src:
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
 
 
 def copy_o_files(srcdir: str, tgtdir: str):
-    '''Copy all object files from srcdir to dstdir, keeping the same directory hierarchy'''
+    '''
+    Copy all object files from srcdir to dstdir, keeping the same directory hierarchy.
+    Files are hard linked where possible: they are only read afterwards, and a worktree is never
+    rebuilt in place (it is removed and checked out again on the next run).
+    '''
+    created = set()
     for objname in iterate_objs(srcdir):
         outname = os.path.join(tgtdir, objname)
-        os.makedirs(os.path.dirname(outname), exist_ok=True)
-        shutil.copy(os.path.join(srcdir, objname), outname)
+        outdir = os.path.dirname(outname)
+        if outdir not in created:
+            os.makedirs(outdir, exist_ok=True)
+            created.add(outdir)
+        src = os.path.join(srcdir, objname)
+        try:
+            os.link(src, outname)
+        except OSError:
+            shutil.copy(src, outname)  # cross-filesystem fallback
+
+
+def _write_section(tgtdir: str, section: bytes, lines: List[bytes], append: bool, compress: bool):
+    '''
+    Write the lines of a disassembled section to tgtdir, zstd-compressed if compress is set.
+    If append is set, add them to an earlier part of the same section.
+    '''
+    # tgtdir must already exist: all sections are written directly into it
+    body = b'\n'.join(lines)
+    if append:
+        body = b'\n' + body
+    name = hashlib.sha1(section).hexdigest()
+    if compress:
+        # An appended part becomes a second zstd frame, which decompresses to the concatenation
+        body = zstandard.ZstdCompressor(level=1).compress(body)
+        outname = os.path.join(tgtdir, name + DIS_ZST_EXT)
+    else:
+        outname = os.path.join(tgtdir, name + DIS_EXT)
+    with open(outname, 'ab' if append else 'wb') as f:
+        f.write(body)
+
+
+def _get_write_pool() -> ThreadPoolExecutor:
+    '''
+    Return the thread pool used to hash and write sections, created on first use in each process.
+    '''
+    global _write_pool, _write_pool_pid
+    if _write_pool is None or _write_pool_pid != os.getpid():
+        _write_pool = ThreadPoolExecutor(max_workers=WRITE_THREADS)
+        _write_pool_pid = os.getpid()
+    return _write_pool
+
+
+def _objdump_obj(objname: str, tgtdir: str, compress: bool):
+    '''
+    Disassemble a single object file and write its sections to tgtdir.
+    '''
+    # Stream the output as bytes, so that only one section at a time is kept in memory.
+    # objdump output is never decoded; stderr goes to a file so that it cannot block the pipe.
+    err = tempfile.TemporaryFile()
+    p = subprocess.Popen([OBJDUMP] + OBJDUMP_ARGS + [objname],
+                         stdout=subprocess.PIPE, stderr=err, bufsize=1024*1024)
+
+    # Sections are hashed and written in the background while parsing continues
+    pool = _get_write_pool()
+    futures = []
+    pending = {}
+
+    def submit_section(section: bytes, lines: List[bytes]):
+        append = section in pending
+        if append:
+            pending[section].result()  # parts of a section must be written in order
+        pending[section] = pool.submit(_write_section, tgtdir, section, lines, append, compress)
+        futures.append(pending[section])
+
+    # postprocess- break into sections separated by 'Disassembly of section...'
+    # the '' header section before the first one is dropped
+    funcname = b''
+    lines = []
+    with p.stdout:
+        for line in p.stdout:
+            line = line.rstrip(b'\n')
+            if line.startswith(_SECTION_PREFIX):
+                if funcname:
+                    submit_section(funcname, lines)
+                funcname = line[len(_SECTION_PREFIX):-1]  # strip trailing ':'
+                lines = []
+            if funcname and _RODATA not in line:  # filter out 'ebc: R_X86_64_32        .rodata+0x1944'
+                lines.append(line)
+    if funcname:
+        submit_section(funcname, lines)
+    wait(futures)
+    with err:
+        if p.wait() != 0:
+            err.seek(0)
+            raise Exception('objdump failed: {}'.format(err.read().decode('ascii', 'replace').strip()))
+    for future in futures:
+        future.result()
+
+
+def sha256_file(filename: str, prefix: bytes = b'') -> str:
+    '''
+    Return the SHA256 hex digest of prefix followed by the contents of a file.
+    '''
+    new_hash = functools.partial(hashlib.sha256, prefix)
+    with open(filename, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+            return hashlib.file_digest(f, new_hash).hexdigest()
+        h = new_hash()
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            h.update(chunk)
+        return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _objdump_version() -> str:
+    '''
+    Return the version output of objdump, which is only run once.
+    '''
+    return subprocess.run([OBJDUMP, '--version'], stdout=subprocess.PIPE, check=True).stdout.decode('ascii', 'replace')
+
+
+def _analysis_key(compress: bool) -> str:
+    '''
+    Describe how analysis results are produced, to include in cache keys.
+    This covers the objdump version and command line, and the version of the post-processing in this script.
+    '''
+    return 'analysis-v{}\n{}\n{}'.format(ANALYSIS_VERSION, _objdump_version(),
+                                         shell_join([OBJDUMP] + OBJDUMP_ARGS + [DIS_ZST_EXT if compress else DIS_EXT]))
+
+
+def _obj_digest(objname: str, analysis_key: str) -> str:
+    '''
+    Hash the contents of an object file, as well as the way it is analyzed.
+    '''
+    return sha256_file(objname, analysis_key.encode())
+
+
+def _link_file(src: str, dst: str):
+    '''
+    Hard link src to dst. Copy if src and dst are not on the same filesystem.
+    dst must not exist yet: existing files are never written to in place, as they may be links into the cache.
+    '''
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        raise
+    except OSError:
+        with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+            shutil.copyfileobj(fsrc, fdst)
+
+
+def _link_files(srcdir: str, tgtdir: str):
+    '''
+    Hard link all files in srcdir into tgtdir.
+    '''
+    with os.scandir(srcdir) as it:
+        for entry in it:
+            _link_file(entry.path, os.path.join(tgtdir, entry.name))
+
 
+def _process_one_obj(objname: str, srcdir: str, compress: bool, analysis_key: str) -> Tuple[str, str]:
+    '''
+    Analyze a single object file, reusing the cached result if the same object file was analyzed before.
+    Return the object name and the cache directory holding its section files.
+    '''
+    objname = os.path.join(srcdir, objname)
+    cachedir = os.path.join(OBJDUMP_CACHE_DIR, _obj_digest(objname, analysis_key))
+    if not os.path.isdir(cachedir):
+        # Populate a private directory first, then move it into place, so that
+        # an interrupted or concurrent run never sees a partial result
+        tmpdir = tempfile.mkdtemp(dir=OBJDUMP_CACHE_DIR)
+        try:
+            _objdump_obj(objname, tmpdir, compress)
+            os.rename(tmpdir, cachedir)
+        except OSError:
+            if not os.path.isdir(cachedir):
+                raise
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return (objname, cachedir)
 
-def objdump_all(srcdir: str, tgtdir: str):
+
+def objdump_all(srcdir: str, tgtdir: str, parallelism: int = DEFAULT_PARALLELISM, compress: bool = False):
     '''
     Object analysis pass using objdump.
+    Object files are processed in parallel, using up to `parallelism` worker processes.
+    If compress is set, section files are written zstd-compressed (requires the zstandard module).
+    Results are cached in OBJDUMP_CACHE_DIR by object file contents, and persist across runs.
     '''
-    for objname in iterate_objs(srcdir):
-        objname = os.path.join(srcdir, objname)
-        p = subprocess.Popen([OBJDUMP] + OBJDUMP_ARGS + [objname],
-                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (out, err) = p.communicate()
-        if p.returncode != 0:
-            raise Exception('objdump failed')
-        (out, err) = (out.decode(), err.decode())
-
-        # postprocess- break into sections separated by 'Disassembly of section...'
-        sections = defaultdict(list)
-        funcname = ''
-        for line in out.splitlines():
-            match = re.match('^Disassembly of section (.*):$', line)
-            if match:
-                funcname = match.group(1)
-            if not '.rodata' in line:  # filter out 'ebc: R_X86_64_32        .rodata+0x1944'
-                sections[funcname].append(line)
-
-        '''
-        lines = []
-        for section in sorted(sections.keys()): # '' header section automatically comes first
-            #lines.extend(sections[section])
-            lines.append(sections[section][0])
-        out = '\n'.join(lines)
-
-        outname = os.path.join(tgtdir, objname[:-len(OBJEXT)] + '.dis')
-        make_parent_dirs(outname)
-        with open(outname, 'w') as f:
-            f.write(out)
-        '''
-        for section in sections.keys():
-            if not section:
-                continue
-            name = hashlib.sha1(section.encode()).hexdigest()
-            outname = os.path.join(tgtdir, name + '.dis')
-            os.makedirs(os.path.dirname(outname), exist_ok=True)
-            with open(outname, 'w') as f:
-                f.write('\n'.join(sections[section]))
+    os.makedirs(OBJDUMP_CACHE_DIR, exist_ok=True)
+    os.makedirs(tgtdir, exist_ok=True)
+    worker = functools.partial(_process_one_obj, srcdir=srcdir, compress=compress,
+                               analysis_key=_analysis_key(compress))
+    # Builds call this from multiple threads at once, and forking a multi-threaded process is unsafe,
+    # so start the workers from a separate server process instead.
+    mp_context = multiprocessing.get_context('forkserver')
+    with ProcessPoolExecutor(max_workers=parallelism, mp_context=mp_context) as executor:
+        # Workers only fill the cache. Sections with the same name can come from different objects, so
+        # which file is kept is decided here, in sorted object order: the first one wins. This makes the
+        # result independent of timing, and every file is placed exactly once.
+        # An exception in any worker is re-raised here.
+        sections = {}
+        for (objname, cachedir) in executor.map(worker, sorted(iterate_objs(srcdir)), chunksize=16):
+            with os.scandir(cachedir) as it:
+                for entry in it:
+                    sections.setdefault(entry.name, entry.path)
+    for (name, path) in sections.items():
+        _link_file(path, os.path.join(tgtdir, name))
 
     # some TODO s, learning about the objdump output:
     # - demangle section names
@@ -233,6 +436,115 @@ def objdump_all(srcdir: str, tgtdir: str):
     # - or could use a different disassembler completely, such as capstone. Parsing objdump output is a hack.
 
 
+def add_worktree(commit: str) -> str:
+    '''
+    Check out a commit into a new detached worktree of the repository in CWD, and return its path.
+    A worktree for the same commit left over from an interrupted run is replaced.
+    '''
+    worktree = WORKTREE_PREFIX + commit
+    if os.path.exists(worktree):
+        check_call(['rm', '-rf', worktree])
+    # -f: allow reusing the path if a leftover worktree is still registered
+    check_call([GIT, 'worktree', 'add', '-f', '--detach', worktree, commit])
+    return worktree
+
+
+def remove_worktree(worktree: str):
+    '''
+    Remove a worktree created by add_worktree, including any build output in it.
+    '''
+    check_call([GIT, 'worktree', 'remove', '--force', worktree])
+
+
+def build_commit(commit: str, worktree: str, args, make_args: List[str], cppflags: List[str], stop: threading.Event):
+    '''
+    Build a commit in its worktree and perform the analysis pass on the result, then remove the worktree.
+    The object files and executables are hard linked into the target directory, so they are kept.
+    Nothing is done if stop is set, and stop is set if the build fails.
+    '''
+    if stop.is_set():
+        return
+    try:
+        _build_commit(commit, worktree, args, make_args, cppflags)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        remove_worktree(worktree)
+
+
+def _build_commit(commit: str, worktree: str, args, make_args: List[str], cppflags: List[str]):
+    logger.info("Building {}...".format(commit))
+    stripbuildinfopatch = args.patches[commit] if commit in args.patches else DEFAULT_PATCH
+    commitdir = os.path.join(args.tgtdir, commit)
+    commitdir_obj = os.path.join(args.tgtdir, commit+'.o')
+
+    try:
+        if commit in args.patches:
+            logger.info(
+                'User-defined patch: {}'.format(stripbuildinfopatch))
+        check_call([GIT, 'apply', os.path.join(
+            PATCHDIR, stripbuildinfopatch)], cwd=worktree)
+    except subprocess.CalledProcessError:
+        raise Exception(
+            'Could not apply patch to strip build info. Probably it needs to be updated')
+
+    check_call(['./autogen.sh'], cwd=worktree)
+    logger.info('Running configure script')
+    opt = shell_join(args.opt)
+    # Every commit is built in a different directory, map it away so that __FILE__ does not differ
+    cppflags = cppflags + ['-ffile-prefix-map={}=.'.format(worktree)]
+    # Make ccache rewrite paths relative to the worktree, so that results are shared between worktrees
+    env = dict(os.environ, CCACHE_BASEDIR=worktree)
+    check_call(['./configure', '--disable-hardening', '--without-cli', '--disable-tests', '--disable-bench',
+                '--enable-ccache' if args.ccache else '--disable-ccache',
+                '--prefix={}'.format(
+                    args.prefix) if args.prefix else '--with-incompatible-bdb',
+                'CPPFLAGS='+(' '.join(cppflags)),
+                'CFLAGS='+opt, 'CXXFLAGS='+opt, 'LDFLAGS='+opt] + CONFIGURE_EXTRA, cwd=worktree, env=env)
+
+    for name in args.executables:
+        logger.info('Building executable {}'.format(name))
+        target_name = os.path.join(
+            args.tgtdir, os.path.basename(name) + '.' + commit)
+        check_call([MAKE] + make_args + [name], cwd=worktree, env=env)
+        try:
+            os.link(os.path.join(worktree, name), target_name)
+        except OSError:
+            shutil.copy(os.path.join(worktree, name), target_name)  # cross-filesystem fallback
+        check_call([OBJCOPY] + OBJCOPY_ARGS +
+                   [os.path.join(worktree, name), target_name + '.stripped'])
+
+    # Skip the analysis if the same executables were analyzed before
+    key = hashlib.sha256('{} {}'.format(commit, _analysis_key(args.zstd)).encode())
+    for name in args.executables:
+        target_name = os.path.join(
+            args.tgtdir, os.path.basename(name) + '.' + commit)
+        key.update('{} {}\n'.format(name, sha256_file(target_name)).encode())
+    cachedir = os.path.join(COMPARE_CACHE_DIR, key.hexdigest())
+    if os.path.isdir(cachedir):
+        logger.info('{} was already analyzed, reusing results'.format(commit))
+        _link_files(cachedir, commitdir)
+        return
+
+    logger.info('Copying object files...')
+    copy_o_files(worktree, commitdir_obj)
+
+    logger.info('Performing basic analysis pass...')
+    objdump_all(commitdir_obj, commitdir, args.parallelism, args.zstd)
+
+    os.makedirs(COMPARE_CACHE_DIR, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=COMPARE_CACHE_DIR)
+    try:
+        _link_files(commitdir, tmpdir)
+        os.rename(tmpdir, cachedir)
+    except OSError:
+        if not os.path.isdir(cachedir):
+            raise
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(
         description='Build to compare binaries. Execute this from a repository directory.')
@@ -244,7 +556,7 @@ def parse_arguments():
     parser.add_argument('--repodir', default=DEFAULT_REPODIR,
                         help='Temp repository directory, default is "{}"'.format(DEFAULT_REPODIR))
     parser.add_argument('--parallelism', '-j', default=DEFAULT_PARALLELISM, type=int,
-                        help='Make parallelism, default is {}'.format(DEFAULT_PARALLELISM))
+                        help='Make and analysis parallelism, default is {}'.format(DEFAULT_PARALLELISM))
     parser.add_argument('--assertions', default=DEFAULT_ASSERTIONS, type=int,
                         help='Build with assertions, default is {}'.format(DEFAULT_ASSERTIONS))
     parser.add_argument('--opt', default=None, type=str,
@@ -253,8 +565,12 @@ def parse_arguments():
                         help='Comma separated list of stripbuildinfo patches to apply, one per hash (in order).')
     parser.add_argument('--prefix', default=None, type=str,
                         help='A depends prefix that will be passed to configure')
+    parser.add_argument('--ccache', default=DEFAULT_CCACHE, type=int,
+                        help='Use ccache for compilation if it is available, default is {}'.format(DEFAULT_CCACHE))
+    parser.add_argument('--zstd', default=DEFAULT_ZSTD, type=int,
+                        help='Write zstd-compressed section files (requires the zstandard module), default is {}'.format(DEFAULT_ZSTD))
     parser.add_argument('--nocopy', default=DEFAULT_NOCOPY, type=int,
-                        help='Build directly in the repository. If unset, will rsync or copy the repository to a temporary directory first, default is {}'.format(DEFAULT_NOCOPY))
+                        help='Create the build worktrees directly from the repository. If unset, will rsync or copy the repository to a temporary directory first, default is {}'.format(DEFAULT_NOCOPY))
     args = parser.parse_args()
     args.patches = dict(zip(args.commitids, [v.strip() for v in args.patches.split(
         ',')])) if args.patches is not None else {}
@@ -292,9 +608,7 @@ def main():
                     check_call(['rm', '-rf', args.tgtdir])
 
         for commit in args.commitids:
-            try:
-                int(commit, 16)
-            except ValueError:
+            if not _HEX_RE.fullmatch(commit):
                 logger.error(
                     '{} is not a hexadecimal commit id. It\'s the only thing we know.'.format(commit))
                 exit(1)
@@ -311,13 +625,18 @@ def main():
             else:
                 gitdir = os.path.join(args.repodir, '.git')
                 logger.warning(
-                    'Command "rsync" not found; resorting to cp, which tends to be slower.')
+                    'Command "rsync" not found; copying repository with hard-linked git objects instead.')
                 logger.info('Copying repository ...')
                 # Touch (to avoid file not found) and remove repodir/.git so we don't end up with repodir/.git/.git
                 check_call(['mkdir', '-p', args.repodir])
                 check_call(['touch', gitdir])
                 check_call(['rm', '-rf', gitdir])
-                check_call(['cp', '-r', '.git', args.repodir])
+                try:
+                    shutil.copytree('.git', gitdir, copy_function=link_git_file)
+                except OSError:
+                    logger.warning('Hard-linked copy failed; resorting to cp, which tends to be slower.')
+                    check_call(['rm', '-rf', gitdir])
+                    check_call(['cp', '-r', '.git', args.repodir])
             # Go to repo
             os.chdir(args.repodir)
 
@@ -325,67 +644,73 @@ def main():
         make_args = []
         if args.parallelism is not None:
             make_args += ['-j{}'.format(args.parallelism)]
+        # Use ccache if requested and available
+        if args.ccache:
+            args.ccache = cmd_exists(CCACHE)
+            if args.ccache:
+                logger.warning(
+                    'Using ccache. Use --ccache=0 if you suspect it of causing differences between builds.')
+        # Compress analysis output if requested and possible
+        if args.zstd and zstandard is None:
+            logger.warning(
+                'Python module "zstandard" not found; writing uncompressed section files.')
+            args.zstd = 0
         # Disable assertions if requested
         cppflags = CPPFLAGS
         if not args.assertions:
             cppflags += ['-DNDEBUG']
 
-        for commit in args.commitids:
-            logger.info("Building {}...".format(commit))
-            stripbuildinfopatch = args.patches[commit] if commit in args.patches else DEFAULT_PATCH
-            commitdir = os.path.join(args.tgtdir, commit)
-            commitdir_obj = os.path.join(args.tgtdir, commit+'.o')
-
-            try:
-                os.makedirs(commitdir)
-            except FileExistsError:
-                logger.error("{} already exists; skipping".format(commitdir))
-                continue
-            check_call([GIT, 'reset', '--hard'])
-            check_call([GIT, 'clean', '-f', '-x', '-d'])
-            check_call([GIT, 'checkout', commit])
+        # Check out every commit in its own worktree, so that they can be built concurrently
+        worktrees = []
+        try:
+            for commit in args.commitids:
+                commitdir = os.path.join(args.tgtdir, commit)
+                try:
+                    os.makedirs(commitdir)
+                except FileExistsError:
+                    logger.error("{} already exists; skipping".format(commitdir))
+                    continue
+                worktrees.append((commit, add_worktree(commit)))
+
+            # Run as many builds at the same time as there are cores for the make parallelism
+            builds = max(1, min(len(worktrees), (os.cpu_count() or 1) // args.parallelism))
+            executor = ThreadPoolExecutor(max_workers=builds)
+            stop = threading.Event()
             try:
-                if commit in args.patches:
-                    logger.info(
-                        'User-defined patch: {}'.format(stripbuildinfopatch))
-                check_call([GIT, 'apply', os.path.join(
-                    PATCHDIR, stripbuildinfopatch)])
-            except subprocess.CalledProcessError:
-                logger.error(
-                    'Could not apply patch to strip build info. Probably it needs to be updated')
-                exit(1)
-
-            check_call(['./autogen.sh'])
-            logger.info('Running configure script')
-            opt = shell_join(args.opt)
-            check_call(['./configure', '--disable-hardening', '--without-cli', '--disable-tests', '--disable-bench', '--disable-ccache',
-                        '--prefix={}'.format(
-                            args.prefix) if args.prefix else '--with-incompatible-bdb',
-                        'CPPFLAGS='+(' '.join(cppflags)),
-                        'CFLAGS='+opt, 'CXXFLAGS='+opt, 'LDFLAGS='+opt] + CONFIGURE_EXTRA)
-
-            for name in args.executables:
-                logger.info('Building executable {}'.format(name))
-                target_name = os.path.join(
-                    args.tgtdir, os.path.basename(name) + '.' + commit)
-                check_call([MAKE] + make_args + [name])
-                shutil.copy(name, target_name)
-                check_call([OBJCOPY] + OBJCOPY_ARGS +
-                           [name, target_name + '.stripped'])
-
-            logger.info('Copying object files...')
-            copy_o_files('.', commitdir_obj)
-
-            logger.info('Performing basic analysis pass...')
-            objdump_all(commitdir_obj, commitdir)
+                futures = [executor.submit(build_commit, commit, worktree, args, make_args, cppflags, stop)
+                           for (commit, worktree) in worktrees]
+                # Stop at the first failed build, instead of building all remaining commits first
+                (done, _) = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    future.result()
+            finally:
+                # Builds that did not start yet are cancelled or skipped; running ones are waited for
+                stop.set()
+                executor.shutdown(wait=True, cancel_futures=True)
+        finally:
+            # Every build removes its own worktree. Remove those of builds that never ran.
+            for (commit, worktree) in worktrees:
+                if os.path.exists(worktree):
+                    remove_worktree(worktree)
 
         if len(args.commitids) > 1:
-            logger.info('Use these commands to compare results:')
-            logger.info('$ sha256sum {}/*.stripped'.format(args.tgtdir))
-            logger.info('$ git diff -W --word-diff {} {}'.format(os.path.join(args.tgtdir,
-                        args.commitids[0]), os.path.join(args.tgtdir, args.commitids[1])))
+            logger.info('Hashes of stripped executables:')
+            for name in args.executables:
+                for commit in args.commitids:
+                    stripped_name = os.path.join(
+                        args.tgtdir, os.path.basename(name) + '.' + commit + '.stripped')
+                    if os.path.exists(stripped_name):
+                        logger.info('{}  {}'.format(sha256_file(stripped_name), stripped_name))
+            dirs = (os.path.join(args.tgtdir, args.commitids[0]), os.path.join(args.tgtdir, args.commitids[1]))
+            if args.zstd:
+                logger.info('Use these commands to compare results:')
+                logger.info('$ zstd -q -d -r --rm {} {}'.format(*dirs))
+            else:
+                logger.info('Use this command to compare results:')
+            logger.info('$ git diff -W --word-diff {} {}'.format(*dirs))
     except Exception:
         logger.exception('Error:')
+        exit(1)
 
 
 if __name__ == '__main__':
@@ -3,7 +3,8 @@
 Simple script to check the status of all Koyotecoin Core DNS seeds.
 Seeds are available from https://github.com/koyotecoin/koyotecoin/blob/master/src/chainparams.cpp
 '''
-import subprocess
+import socket
+from concurrent.futures import ThreadPoolExecutor
 
 SEEDS_PER_NETWORK = {
     'mainnet': [
@@ -22,27 +23,30 @@ SEEDS_PER_NETWORK = {
 
 
 def check_seed(x):
-    p = subprocess.run(["host", x], capture_output=True,
-                       universal_newlines=True)
-    out = p.stdout
+    try:
+        infos = socket.getaddrinfo(x, None, type=socket.SOCK_STREAM)
+    except socket.gaierror:
+        infos = []
 
-    # Parse matching lines
-    addresses = []
-    for line in out.splitlines():
-        if "has address" in line or "has IPv6 address" in line:
-            addresses.append(line)
+    # Count unique IPv4 and IPv6 addresses
+    addresses = {info[4][0] for info in infos}
 
     if addresses:
-        print(f"\x1b[94mOK\x1b[0m   {x} ({len(addresses)} results)")
+        return f"\x1b[94mOK\x1b[0m   {x} ({len(addresses)} results)"
     else:
-        print(f"\x1b[91mFAIL\x1b[0m {x}")
+        return f"\x1b[91mFAIL\x1b[0m {x}"
 
 
 if __name__ == '__main__':
-    for (network, seeds) in SEEDS_PER_NETWORK.items():
-        print(f"\x1b[90m* \x1b[97m{network}\x1b[0m")
+    # Look up all seeds concurrently, but print the results in order
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = {network: [executor.submit(check_seed, hostname) for hostname in seeds]
+                   for (network, seeds) in SEEDS_PER_NETWORK.items()}
 
-        for hostname in seeds:
-            check_seed(hostname)
+        for (network, futures) in results.items():
+            print(f"\x1b[90m* \x1b[97m{network}\x1b[0m")
 
-        print()
+            for future in futures:
+                print(future.result())
+
+            print()
@@ -3,6 +3,11 @@ import subprocess
 import sys
 import re
 import os
+from operator import itemgetter
+
+LOG_RE = re.compile(rb'Leaving test case "(.*)".*: ([0-9]+)(us|mks|ms)')
+# Print a progress dot every this many lines of output
+PROGRESS_INTERVAL = 256
 
 
 def main():
@@ -15,21 +20,19 @@ def main():
     args = [test_koyotecoin, '--log_level=test_suite']
     if len(sys.argv) > 2:
         args += ['--run_test=' + sys.argv[2]]
-    p = subprocess.Popen(args, stdout=subprocess.PIPE)
+    p = subprocess.Popen(args, stdout=subprocess.PIPE, bufsize=1 << 20)
     results = []
-    for line in p.stdout:
-        if not line:
-            break
-        line = line.decode()
-        m = re.match('.*Leaving test case "(.*)".*: ([0-9]+)(us|mks|ms)', line)
+    for (count, line) in enumerate(p.stdout, 1):
+        m = LOG_RE.search(line)
         if m:
-            if m.group(3) == 'ms':
+            if m.group(3) == b'ms':
                 elapsed = int(m.group(2)) * 1000
             else:
                 elapsed = int(m.group(2))
-            results.append((m.group(1), elapsed))
-        sys.stderr.write('.')
-        sys.stderr.flush()
+            results.append((m.group(1).decode(), elapsed))
+        if count % PROGRESS_INTERVAL == 0:
+            sys.stderr.write('.')
+            sys.stderr.flush()
     sys.stderr.write('\n')
     sys.stderr.flush()
     rv = p.wait()
@@ -37,7 +40,7 @@ def main():
     if rv == 0:
         print('| {:<55} | {:^9} |'.format('Test', 'Time (μs)'))
         print('| {} | {}:|'.format('-'*55, '-'*9))
-        results.sort(key=lambda a: -a[1])
+        results.sort(key=itemgetter(1), reverse=True)
         for a in results:
             print('| {:<55} | {:>9} |'.format('`'+a[0]+'`', a[1]))
 